@@ -158,6 +158,46 @@ CACHES = {
 
 ROOM_NAME = 'index'
 
+# seconds a display may take to ack a frame before it is considered stalled and disconnected
+CLIENT_STALL_TIMEOUT = env.int("CLIENT_STALL_TIMEOUT", default=30)
+
+# bearer token required for /metrics and /traces when DEBUG is off; unset to disable them
+STATS_TOKEN = env("STATS_TOKEN", default=None)
+
+# uploads at least this big show Slack's thumbnail as a placeholder while the full file downloads
+PLACEHOLDER_MIN_BYTES = env.int("PLACEHOLDER_MIN_BYTES", default=500_000)
+
+# maximum number of files fetched at once from a single multi-file share, and seconds to wait on each
+SHARE_FETCH_WORKERS = env.int("SHARE_FETCH_WORKERS", default=4)
+SHARE_FETCH_TIMEOUT = env.int("SHARE_FETCH_TIMEOUT", default=30)
+
+# up to PREFETCH_MAX_URLS images linked in a message are prefetched before Slack unfurls them, PREFETCH_WORKERS
+# at a time, if no bigger than PREFETCH_MAX_BYTES; unused prefetches expire after PREFETCH_TTL seconds
+PREFETCH_MAX_URLS = env.int("PREFETCH_MAX_URLS", default=3)
+PREFETCH_WORKERS = env.int("PREFETCH_WORKERS", default=2)
+PREFETCH_MAX_BYTES = env.int("PREFETCH_MAX_BYTES", default=10_000_000)
+PREFETCH_TIMEOUT = env.int("PREFETCH_TIMEOUT", default=10)
+PREFETCH_TTL = env.int("PREFETCH_TTL", default=120)
+
+# message history keeps at most MESSAGE_HISTORY_MAX_ITEMS messages, and evicts the html of older messages
+# (see main.helpers.EVICTION_POLICIES) once it exceeds MESSAGE_HISTORY_MAX_BYTES
+MESSAGE_HISTORY_MAX_ITEMS = env.int("MESSAGE_HISTORY_MAX_ITEMS", default=5)
+MESSAGE_HISTORY_MAX_BYTES = env.int("MESSAGE_HISTORY_MAX_BYTES", default=20_000_000)
+MESSAGE_HISTORY_EVICTION = env("MESSAGE_HISTORY_EVICTION", default="oldest")
+MESSAGE_HISTORY_EVICTED_TTL = env.int("MESSAGE_HISTORY_EVICTED_TTL", default=7 * 24 * 60 * 60)
+
+# seconds to keep traces of Slack events for the /traces report
+TRACE_TTL = env.int("TRACE_TTL", default=60 * 60)
+
+# opt-in sample profiling; see main/profiling.py. PROFILE_SAMPLE_RATE can be overridden at runtime
+# with `./manage.py profiling <rate>`
+PROFILE_SAMPLE_RATE = env.float("PROFILE_SAMPLE_RATE", default=0)
+PROFILE_CHECK_INTERVAL = env.int("PROFILE_CHECK_INTERVAL", default=10)
+PROFILE_DIR = env("PROFILE_DIR", default=str(BASE_DIR / 'profiles'))
+PROFILE_TRACEMALLOC = env.bool("PROFILE_TRACEMALLOC", default=False)
+PROFILE_TRACEMALLOC_FRAMES = env.int("PROFILE_TRACEMALLOC_FRAMES", default=10)
+PROFILE_TRACEMALLOC_MIN_BYTES = env.int("PROFILE_TRACEMALLOC_MIN_BYTES", default=10_000_000)
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
@@ -187,6 +227,11 @@ LOGGING = {
             # required to avoid double logging with root logger
             'propagate': False,
         },
+        'main.tracing': {
+            'level': env("LOGLEVEL", default="DEBUG"),
+            'handlers': ['console'],
+            'propagate': False,
+        },
     }
 }
 
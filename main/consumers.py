@@ -1,14 +1,32 @@
 from asgiref.sync import async_to_sync
 from channels.generic.websocket import WebsocketConsumer
 import json
+import threading
+import time
 
 from django.conf import settings
+from django.core.cache import cache
 
-from .helpers import get_message_history, send_state
+from . import metrics, tracing
+from .helpers import get_message_history, get_state, send_state
+from .profiling import profiled
+
+import logging
+logger = logging.getLogger(__name__)
+
+# seconds between reports of an unacked frame's age, and checks for it being stalled
+STALL_CHECK_INTERVAL = 5
 
 
 class Consumer(WebsocketConsumer):
+    """
+        Sends state to a single display. At most one frame is in flight at a time: newer states
+        that arrive while the display is still working on a frame are coalesced, and only the latest
+        is sent once the display acks. Displays that don't ack within settings.CLIENT_STALL_TIMEOUT
+        are disconnected, so one slow screen never backs up the rest of the room.
+    """
 
+    @profiled("consumer_connect")
     def connect(self):
         # add new connections to group
         async_to_sync(self.channel_layer.group_add)(
@@ -17,17 +35,125 @@ class Consumer(WebsocketConsumer):
         )
         self.accept()
 
+        self.sent_versions = {}  # version of each state key last sent to this client
+        self.sent_version = 0  # version of the last frame sent
+        self.latest_version = 0  # newest version we've been notified of
+        self.in_flight = None  # (version, sent_at, trace id) of the frame awaiting an ack
+        self.acked_version = 0
+        self.ack_lag = None  # seconds the last acked frame took to be acked
+        self.stall_timer = None  # schedules check_stall() while a frame is in flight; one at a time
+        self.stall_check_pending = False
+        self.traces = {}  # version: id of the trace that produced it, for versions not yet sent
+        self.dropped = 0
+
+        # seed state saved before state was kept in the cache
+        if not cache.get("state_version"):
+            with get_message_history() as message_history:
+                if message_history:
+                    send_state(message_history[-1])
+
         # send data for last image
-        with get_message_history() as message_history:
-            if message_history:
-                send_state(message_history[-1])
+        self.send_latest_state()
 
     def disconnect(self, close_code):
         # leave room group
         async_to_sync(self.channel_layer.group_discard)(
             settings.ROOM_NAME,
             self.channel_name)
+        metrics.clear(f"client:{self.channel_name}")
+        if self.stall_timer:
+            self.stall_timer.cancel()
+
+    @profiled("consumer_receive")
+    def receive(self, text_data=None, bytes_data=None):
+        """ Handle acks sent by the client once it has rendered a frame. """
+        try:
+            message = json.loads(text_data)
+        except (TypeError, ValueError):
+            return
+        if self.in_flight and message.get('ack') == self.in_flight[0]:
+            version, sent_at, trace_id = self.in_flight
+            self.in_flight = None
+            self.acked_version = version
+            self.ack_lag = time.monotonic() - sent_at
+            if trace_id:
+                tracing.record_ack(trace_id, self.channel_name, self.ack_lag)
+            self.report_metrics()
+            if self.latest_version > version:
+                self.send_latest_state()
 
+    @profiled("consumer_share_state")
     def share_state(self, event):
         """ Event handler to send current state to client. Triggered by send_state(). """
-        self.send(json.dumps(event['state']))
\ No newline at end of file
+        self.latest_version = max(self.latest_version, event['version'])
+        if event.get('trace') and event['version'] > self.sent_version:
+            self.traces[event['version']] = event['trace']
+        if self.in_flight:
+            # the latest state will be sent when the client acks the current frame
+            self.check_stall()
+        else:
+            self.send_latest_state()
+
+    def check_stall(self, event=None):
+        """
+            Report how long the in-flight frame has been waiting for an ack, and close the connection
+            if it's been too long. Also triggered by stall_timer, via request_stall_check().
+        """
+        if event is not None:
+            self.stall_check_pending = False
+        if not self.in_flight:
+            return
+        version, sent_at, trace_id = self.in_flight
+        age = time.monotonic() - sent_at
+        self.report_metrics(in_flight_age=age)
+        if age > settings.CLIENT_STALL_TIMEOUT:
+            logger.warning(f"Closing stalled client {self.channel_name}: no ack for version {version}")
+            metrics.incr("clients_closed_stalled")
+            self.in_flight = None
+            self.close()
+        else:
+            self.schedule_stall_check()
+
+    def schedule_stall_check(self):
+        """ While a frame is in flight, keep one check_stall() scheduled, at most STALL_CHECK_INTERVAL away. """
+        if self.in_flight and not self.stall_check_pending:
+            version, sent_at, trace_id = self.in_flight
+            remaining = settings.CLIENT_STALL_TIMEOUT - (time.monotonic() - sent_at)
+            self.stall_check_pending = True
+            self.stall_timer = threading.Timer(min(max(remaining, 0), STALL_CHECK_INTERVAL) + 0.1, self.request_stall_check)
+            self.stall_timer.daemon = True
+            self.stall_timer.start()
+
+    def request_stall_check(self):
+        """ Runs on stall_timer's thread, so hand the check back to the consumer via the channel layer. """
+        async_to_sync(self.channel_layer.send)(self.channel_name, {'type': 'check_stall'})
+
+    def report_metrics(self, in_flight_age=0):
+        metrics.gauge(f"client:{self.channel_name}", {
+            "ack_lag": self.ack_lag and round(self.ack_lag, 3),
+            "in_flight_age": round(in_flight_age, 3),
+            "versions_behind": self.latest_version - self.acked_version,
+            "dropped": self.dropped,
+        }, timeout=3600)
+
+    def send_latest_state(self):
+        """ Send whatever state has changed since the last frame sent to this client. """
+        state, versions = get_state(self.sent_versions)
+        if not state:
+            return
+        version = max(versions.values())
+        if self.sent_version and version > self.sent_version + 1:
+            # intermediate versions were superseded before this client could receive them
+            self.dropped += version - self.sent_version - 1
+            metrics.incr("frames_dropped", version - self.sent_version - 1)
+        self.sent_versions.update(versions)
+        self.sent_version = version
+        self.latest_version = max(self.latest_version, version)
+
+        # attribute the frame to the trace of the newest version it includes
+        trace_id = self.traces.get(version)
+        self.traces = {v: t for v, t in self.traces.items() if v > version}
+
+        self.in_flight = (version, time.monotonic(), trace_id)
+        self.schedule_stall_check()
+        self.send(json.dumps({'version': version, 'trace': trace_id, 'state': state}))
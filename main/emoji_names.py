@@ -0,0 +1,89 @@
+# Slack short names (and their aliases) of the standard emoji that have a color word or 'night'
+# as a word in any of their names, grouped by emoji. Generated from the names and aliases in the
+# emoji package's data (https://pypi.org/project/emoji/, 2.16.0); regenerate when Slack adds emoji.
+COLOR_EMOJI_NAMES = [
+    ('apple', 'red_apple'),
+    ('automobile', 'car', 'red_car'),
+    ('black_bird', 'crow', 'raven', 'rook'),
+    ('black_cat',),
+    ('black_circle',),
+    ('black_circle_for_record', 'record_button'),
+    ('black_flag', 'waving_black_flag'),
+    ('black_heart',),
+    ('black_joker', 'joker'),
+    ('black_large_square',),
+    ('black_left_pointing_double_triangle_with_vertical_bar', 'last_track_button', 'previous_track_button'),
+    ('black_medium-small_square', 'black_medium_small_square'),
+    ('black_medium_square',),
+    ('black_nib',),
+    ('black_right_pointing_double_triangle_with_vertical_bar', 'next_track_button'),
+    ('black_right_pointing_triangle_with_double_vertical_bar', 'play_or_pause_button'),
+    ('black_small_square',),
+    ('black_square_button',),
+    ('black_square_for_stop', 'stop_button'),
+    ('blue_book',),
+    ('blue_car', 'sport_utility_vehicle'),
+    ('blue_circle', 'large_blue_circle'),
+    ('blue_heart',),
+    ('blue_square',),
+    ('bridge_at_night',),
+    ('brown_circle',),
+    ('brown_heart',),
+    ('brown_mushroom',),
+    ('brown_square',),
+    ('eight-pointed_star', 'eight_pointed_black_star', 'eight_pointed_star'),
+    ('exclamation', 'heavy_exclamation_mark', 'red_exclamation_mark'),
+    ('green_apple',),
+    ('green_book',),
+    ('green_circle',),
+    ('green_heart',),
+    ('green_salad',),
+    ('green_square',),
+    ('heart', 'red_heart'),
+    ('hollow_red_circle', 'o'),
+    ('izakaya_lantern', 'lantern', 'red_paper_lantern'),
+    ('large_blue_diamond',),
+    ('large_orange_diamond',),
+    ('leafy_green',),
+    ('light_blue_heart',),
+    ('mahjong', 'mahjong_red_dragon'),
+    ('man_dark_skin_tone_red_hair',),
+    ('man_light_skin_tone_red_hair',),
+    ('man_medium-dark_skin_tone_red_hair',),
+    ('man_medium-light_skin_tone_red_hair',),
+    ('man_medium_skin_tone_red_hair',),
+    ('man_red_hair', 'red_haired_man'),
+    ('mandarin', 'orange', 'tangerine'),
+    ('night_with_stars',),
+    ('orange_book',),
+    ('orange_circle',),
+    ('orange_heart',),
+    ('orange_square',),
+    ('person_dark_skin_tone_red_hair',),
+    ('person_light_skin_tone_red_hair',),
+    ('person_medium-dark_skin_tone_red_hair',),
+    ('person_medium-light_skin_tone_red_hair',),
+    ('person_medium_skin_tone_red_hair',),
+    ('person_red_hair',),
+    ('purple_circle',),
+    ('purple_heart',),
+    ('purple_square',),
+    ('question', 'red_question_mark'),
+    ('red_circle',),
+    ('red_envelope',),
+    ('red_hair',),
+    ('red_haired_woman', 'woman_red_hair'),
+    ('red_square',),
+    ('red_triangle_pointed_down', 'small_red_triangle_down'),
+    ('red_triangle_pointed_up', 'small_red_triangle'),
+    ('small_blue_diamond',),
+    ('small_orange_diamond',),
+    ('woman_dark_skin_tone_red_hair',),
+    ('woman_light_skin_tone_red_hair',),
+    ('woman_medium-dark_skin_tone_red_hair',),
+    ('woman_medium-light_skin_tone_red_hair',),
+    ('woman_medium_skin_tone_red_hair',),
+    ('yellow_circle',),
+    ('yellow_heart',),
+    ('yellow_square',),
+]
@@ -7,6 +7,9 @@ from asgiref.sync import async_to_sync
 from channels.layers import get_channel_layer
 from django.conf import settings
 from django.core.cache import cache
+from django.utils.module_loading import import_string
+
+from . import metrics, tracing
 
 import logging
 logger = logging.getLogger(__name__)
@@ -19,21 +22,92 @@ def get_message_history():
 
             with get_message_history() as message_history:
                 # message_history is a list like
-                # [{'id':'...', 'image':'data', 'color':'#fff', 'reactions':['smile', 'red_circle']}]
-                # with the most recent message appearing last.
+                # [{'id':'...', 'html':'...', 'color':'#fff', 'reactions':{'smile': 2, 'red_circle': 1},
+                #   'color_reaction':'red_circle'}]
+                # with the most recent message appearing last. Messages other than the most recent
+                # may have their 'html' evicted to stay under the byte budget; see trim_message_history().
                 # Changes made to message_history inside this block will be persisted.
     """
     # load message history
-    orig_message_history = cache.get("message_history", "[]")
-    message_history = json.loads(orig_message_history)
+    with tracing.span("history_load"):
+        orig_message_history = cache.get("message_history", "[]")
+        message_history = json.loads(orig_message_history)
 
     yield message_history
 
     # trim and save message_history if changed
-    message_history = message_history[-5:]
-    new_message_history = json.dumps(message_history)
-    if new_message_history != orig_message_history:
-        cache.set("message_history", new_message_history)
+    with tracing.span("history_save"):
+        trim_message_history(message_history)
+        new_message_history = json.dumps(message_history)
+        if new_message_history != orig_message_history:
+            cache.set("message_history", new_message_history)
+            metrics.gauge("history_bytes", len(new_message_history))
+            metrics.gauge("history_items", len(message_history))
+            metrics.gauge("history_evicted_items", sum(1 for m in message_history if m.get('evicted')))
+
+def message_size(message):
+    return len(message.get('html', ''))
+
+def evict_oldest(message_history):
+    """ Eviction policy: evict media from the oldest messages first. """
+    return message_history[:-1]
+
+def evict_largest(message_history):
+    """ Eviction policy: evict media from the largest messages first, other than the current one. """
+    return sorted(message_history[:-1], key=message_size, reverse=True)
+
+EVICTION_POLICIES = {
+    'oldest': evict_oldest,
+    'largest': evict_largest,
+}
+
+def get_eviction_policy():
+    """
+        Return the function named by settings.MESSAGE_HISTORY_EVICTION: either a key of EVICTION_POLICIES
+        or a dotted path to a function that takes message_history and returns messages in the order to evict them.
+    """
+    name = settings.MESSAGE_HISTORY_EVICTION
+    return EVICTION_POLICIES.get(name) or import_string(name)
+
+def trim_message_history(message_history):
+    """
+        Limit message_history to settings.MESSAGE_HISTORY_MAX_ITEMS messages, and move the html of
+        messages out of message_history until it fits in settings.MESSAGE_HISTORY_MAX_BYTES.
+        Evicted messages keep their id, color and reactions, and their html stays in the cache for
+        settings.MESSAGE_HISTORY_EVICTED_TTL seconds, in case they become current again, or until
+        they are dropped from message_history.
+    """
+    # always keep the current message
+    excess = len(message_history) - max(settings.MESSAGE_HISTORY_MAX_ITEMS, 1)
+    if excess > 0:
+        for message in message_history[:excess]:
+            if message.get('evicted'):
+                cache.delete(f"evicted_html:{message['id']}")
+        del message_history[:excess]
+    total = sum(message_size(m) for m in message_history)
+    if total <= settings.MESSAGE_HISTORY_MAX_BYTES:
+        return
+    for message in get_eviction_policy()(message_history):
+        if total <= settings.MESSAGE_HISTORY_MAX_BYTES:
+            break
+        # never evict the current message, whatever the policy returns
+        if message is message_history[-1] or message.get('evicted'):
+            continue
+        total -= message_size(message)
+        cache.set(f"evicted_html:{message['id']}", message.pop('html'), timeout=settings.MESSAGE_HISTORY_EVICTED_TTL)
+        message['evicted'] = True
+        metrics.incr("history_evictions")
+
+def restore_message(message):
+    """ Bring back the html of an evicted message. Return False if it has expired. """
+    if message.get('evicted'):
+        html = cache.get(f"evicted_html:{message['id']}")
+        if html is None:
+            return False
+        message['html'] = html
+        del message['evicted']
+        cache.delete(f"evicted_html:{message['id']}")
+    return True
 
 def message_for_ts(message_history, ts):
     """
@@ -50,16 +124,46 @@ def message_for_ts(message_history, ts):
 _state_keys = ('html', 'color')
 
 def send_state(state):
-    """ Send state to listeners. """
+    """
+        Save state and notify listeners. Listeners only receive a version number and read the
+        state itself from the cache, so a slow client skips straight to the newest state instead
+        of working through a backlog of stale frames.
+    """
     # filter state to just expected keys
     state = {k:v for k, v in state.items() if k in _state_keys}
 
-    # send to settings.ROOM_NAME
+    # store each key alongside the version that last changed it; the lock keeps versions and
+    # writes in the same order across threads and processes, so the newest version always wins
+    with cache.lock("state_lock", timeout=10):
+        cache.add("state_version", 0, timeout=None)
+        version = cache.incr("state_version")
+        cache.set_many({f"state:{k}": (version, v) for k, v in state.items()}, timeout=None)
+
+    # notify settings.ROOM_NAME
+    trace = tracing.current()
     channel_layer = get_channel_layer()
-    async_to_sync(channel_layer.group_send)(settings.ROOM_NAME, {
-        'type': 'share_state',
-        'state': state,
-    })
+    with tracing.span("fanout"):
+        async_to_sync(channel_layer.group_send)(settings.ROOM_NAME, {
+            'type': 'share_state',
+            'version': version,
+            'trace': trace and trace.id,
+        })
+
+def get_state(sent_versions):
+    """
+        Given a dict of {key: version} already sent to a client, return (state, versions)
+        containing only the keys that have changed since.
+    """
+    stored = cache.get_many([f"state:{k}" for k in _state_keys])
+    state = {}
+    versions = {}
+    for k in _state_keys:
+        if f"state:{k}" in stored:
+            version, value = stored[f"state:{k}"]
+            if version > sent_versions.get(k, 0):
+                state[k] = value
+                versions[k] = version
+    return state, versions
 
 def send_to_slack(channel, thread_ts, text):
     client = WebClient(token=settings.SLACK['bot_access_token'])
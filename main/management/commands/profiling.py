@@ -0,0 +1,21 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+
+from main.profiling import RATE_CACHE_KEY
+
+
+class Command(BaseCommand):
+    help = "Show or set the fraction of Slack event handlers and consumer callbacks to profile, in all running processes"
+
+    def add_arguments(self, parser):
+        parser.add_argument("rate", nargs="?", type=float, help="fraction of calls to profile, from 0 (off) to 1")
+        parser.add_argument("--reset", action="store_true", help="go back to PROFILE_SAMPLE_RATE from the environment")
+
+    def handle(self, *args, **options):
+        if options["reset"]:
+            cache.delete(RATE_CACHE_KEY)
+        elif options["rate"] is not None:
+            cache.set(RATE_CACHE_KEY, options["rate"], timeout=None)
+        rate = cache.get(RATE_CACHE_KEY, settings.PROFILE_SAMPLE_RATE)
+        self.stdout.write(f"Profiling {rate:.1%} of calls, writing to {settings.PROFILE_DIR}")
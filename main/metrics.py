@@ -0,0 +1,22 @@
+from django.core.cache import cache
+
+
+_prefix = "metrics:"
+
+def incr(name, delta=1):
+    """ Increment a counter shared by all processes. """
+    key = _prefix + name
+    cache.add(key, 0, timeout=None)
+    return cache.incr(key, delta)
+
+def gauge(name, value, timeout=None):
+    """ Record the latest value of a gauge. Pass a timeout for gauges that should vanish if not refreshed. """
+    cache.set(_prefix + name, value, timeout=timeout)
+
+def clear(name):
+    cache.delete(_prefix + name)
+
+def get_metrics():
+    """ Return a dict of all current counters and gauges. """
+    keys = list(cache.iter_keys(_prefix + "*"))
+    return {k[len(_prefix):]: v for k, v in sorted(cache.get_many(keys).items())}
@@ -0,0 +1,81 @@
+"""
+    Opt-in sample profiling of Slack event handlers and WebSocket consumer callbacks.
+
+    Functions decorated with @profiled are run under cProfile for a fraction of calls, set by
+    settings.PROFILE_SAMPLE_RATE or at runtime with `./manage.py profiling <rate>`. Each sampled
+    call writes a .pstats file to settings.PROFILE_DIR, for use with snakeviz, flameprof, gprof2dot
+    etc. If settings.PROFILE_TRACEMALLOC is set, sampled calls also trace allocations, and calls
+    whose peak exceeds settings.PROFILE_TRACEMALLOC_MIN_BYTES get a tracemalloc snapshot written
+    alongside. tracemalloc traces the whole process, so the peak and snapshot also include
+    allocations by anything handled concurrently on other threads; treat the threshold as a hint
+    that the sampled call was among the largest, and check the snapshot's tracebacks to confirm.
+    When disabled, the only overhead is a random() call and, every
+    settings.PROFILE_CHECK_INTERVAL seconds, a cache lookup for a runtime override.
+"""
+import cProfile
+from datetime import datetime
+from functools import wraps
+import os
+from pathlib import Path
+import random
+import threading
+import time
+import tracemalloc
+
+from django.conf import settings
+from django.core.cache import cache
+
+import logging
+logger = logging.getLogger(__name__)
+
+RATE_CACHE_KEY = "profiling:rate"
+
+# only one call is profiled at a time, as cProfile and tracemalloc don't nest across threads
+_lock = threading.Lock()
+_rate = None
+_rate_checked_at = None
+
+
+def sample_rate():
+    """ Return the fraction of calls to profile, preferring a rate set with `./manage.py profiling`. """
+    global _rate, _rate_checked_at
+    now = time.monotonic()
+    if _rate_checked_at is None or now - _rate_checked_at > settings.PROFILE_CHECK_INTERVAL:
+        _rate = cache.get(RATE_CACHE_KEY, settings.PROFILE_SAMPLE_RATE)
+        _rate_checked_at = now
+    return _rate
+
+def profiled(name):
+    """ Decorator to sample-profile calls to a function, writing results under `name`. """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            rate = sample_rate()
+            if not rate or random.random() >= rate or not _lock.acquire(blocking=False):
+                return func(*args, **kwargs)
+            try:
+                return _profile(name, func, args, kwargs)
+            finally:
+                _lock.release()
+        return wrapper
+    return decorator
+
+def _profile(name, func, args, kwargs):
+    path = Path(settings.PROFILE_DIR)
+    path.mkdir(parents=True, exist_ok=True)
+    path = path / f"{name}-{datetime.now():%Y%m%d-%H%M%S-%f}-{os.getpid()}"
+
+    trace_memory = settings.PROFILE_TRACEMALLOC and not tracemalloc.is_tracing()
+    if trace_memory:
+        tracemalloc.start(settings.PROFILE_TRACEMALLOC_FRAMES)
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func, *args, **kwargs)
+    finally:
+        profiler.dump_stats(f"{path}.pstats")
+        if trace_memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            if peak >= settings.PROFILE_TRACEMALLOC_MIN_BYTES:
+                tracemalloc.take_snapshot().dump(f"{path}.tracemalloc")
+                logger.warning(f"{name} allocated up to {peak} bytes; see {path}.tracemalloc")
+            tracemalloc.stop()
@@ -0,0 +1,122 @@
+"""
+    Tracing for Slack events, from Slack's delivery through to each display rendering the result.
+
+    slack_event() creates a Trace, and handle_slack_event() activates it for its thread, so that
+    span() calls anywhere downstream (fetching, loading and saving history, channel-layer fanout)
+    are recorded against it. send_state() forwards the trace id to displays, which ack once they've
+    rendered; Consumer calls record_ack(). Finished traces and acks are logged as JSON and kept in
+    the cache for settings.TRACE_TTL seconds, for slowest_traces() to report on.
+"""
+from contextlib import contextmanager
+import json
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+
+import logging
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+class Trace:
+
+    def __init__(self, event_type=None, event_time=None):
+        self.id = uuid.uuid4().hex
+        self.event_type = event_type
+        self.started = time.time()
+        self.spans = []
+        if event_time:
+            # time from the event happening in Slack to Slack's request reaching us
+            self.add_span("slack_delivery", float(event_time) - self.started, self.started - float(event_time))
+
+    def add_span(self, stage, start, duration, **details):
+        self.spans.append({"stage": stage, "start": round(start, 4), "duration": round(duration, 4), **details})
+
+    @contextmanager
+    def span(self, stage, **details):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_span(stage, start - self.started, time.time() - start, **details)
+
+    def as_dict(self):
+        return {
+            "id": self.id,
+            "event_type": self.event_type,
+            "started": self.started,
+            "spans": self.spans,
+        }
+
+    def finish(self):
+        """ Log the trace and keep it for slowest_traces(). """
+        logger.info(json.dumps({"trace": self.as_dict()}))
+        self.save()
+
+    def save(self):
+        """ Store the trace, e.g. again after spans recorded by background work outlasting the handler. """
+        cache.set(f"trace:{self.id}", self.as_dict(), timeout=settings.TRACE_TTL)
+
+
+@contextmanager
+def activate(trace):
+    """ Make trace the current trace for this thread, and finish it on exit. """
+    if trace is None:
+        yield
+        return
+    trace.add_span("queue", 0, time.time() - trace.started)
+    _local.trace = trace
+    try:
+        with trace.span("handler"):
+            yield
+    finally:
+        _local.trace = None
+        trace.finish()
+
+def current():
+    return getattr(_local, "trace", None)
+
+@contextmanager
+def span(stage, trace=None, **details):
+    """
+        Record a span against trace, or the current trace if any. Work on other threads, such as
+        thread pools, should be passed the trace explicitly.
+    """
+    trace = trace or current()
+    if trace is None:
+        yield
+    else:
+        with trace.span(stage, **details):
+            yield
+
+def record_ack(trace_id, client, render):
+    """ Record that a display rendered the result of a trace, `render` seconds after it was sent. """
+    ack = {"trace": trace_id, "client": client, "acked_at": time.time(), "render": round(render, 4)}
+    logger.info(json.dumps({"ack": ack}))
+    cache.set(f"trace_ack:{trace_id}:{client}", ack, timeout=settings.TRACE_TTL)
+
+def slowest_traces(count=20):
+    """
+        Return recent traces with their display acks, slowest first, measuring from the event
+        happening in Slack to the last display rendering it.
+    """
+    traces = list(cache.get_many(list(cache.iter_keys("trace:*"))).values())
+    acks = cache.get_many(list(cache.iter_keys("trace_ack:*"))).values()
+    for trace in traces:
+        trace["displays"] = [
+            {
+                "client": ack["client"],
+                "render": ack["render"],
+                "since_start": round(ack["acked_at"] - trace["started"], 4),
+            }
+            for ack in acks if ack["trace"] == trace["id"]
+        ]
+        delivery = sum(s["duration"] for s in trace["spans"] if s["stage"] == "slack_delivery")
+        handled = max((s["start"] + s["duration"] for s in trace["spans"]), default=0)
+        rendered = max((d["since_start"] for d in trace["displays"]), default=0)
+        trace["total"] = round(delivery + max(handled, rendered), 4)
+    return sorted(traces, key=lambda t: t["total"], reverse=True)[:count]
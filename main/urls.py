@@ -5,5 +5,7 @@ from . import views
 
 urlpatterns = [
     path('slack_event', views.slack_event),
+    path('metrics', views.metrics_report),
+    path('traces', views.slowest_traces_report),
     path('', TemplateView.as_view(template_name='index.html'), name='index'),
 ]
\ No newline at end of file
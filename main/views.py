@@ -1,24 +1,35 @@
 import base64
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
 from datetime import datetime, time
 import hashlib
 import hmac
+import ipaddress
 import json
 import logging
+import math
 import pytz
 import random
 import re
 import requests
 import threading
-from urllib.parse import urlencode
+from time import monotonic
+from urllib.parse import urlencode, urlparse
 import os
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import NewConnectionError
 
 from django.conf import settings
-from django.core.exceptions import SuspiciousOperation
-from django.http import HttpResponse
+from django.core.cache import cache
+from django.core.exceptions import PermissionDenied, SuspiciousOperation
+from django.http import HttpResponse, JsonResponse
 from django.utils.encoding import force_bytes, force_str
 from django.views.decorators.csrf import csrf_exempt
-from main.helpers import get_message_history, message_for_ts, send_state, send_to_slack
+from main.helpers import get_message_history, message_for_ts, restore_message, send_state, send_to_slack
+from main import metrics, tracing
+from main.emoji_names import COLOR_EMOJI_NAMES
 from main.moongazing import MOONGAZING_URLS
+from main.profiling import profiled
 
 logger = logging.getLogger(__name__)
 
@@ -36,28 +47,83 @@ def verify_slack_request(request):
     if not hmac.compare_digest(expected_signature, force_str(request.META.get("HTTP_X_SLACK_SIGNATURE", ""))):
         raise SuspiciousOperation("Slack signature verification failed")
 
+def verify_stats_request(request):
+    """ Raise PermissionDenied unless DEBUG is on or the request has an `Authorization: Bearer <STATS_TOKEN>` header. """
+    if settings.DEBUG:
+        return
+    token = request.META.get("HTTP_AUTHORIZATION", "").removeprefix("Bearer ")
+    if not settings.STATS_TOKEN or not hmac.compare_digest(force_bytes(token), force_bytes(settings.STATS_TOKEN)):
+        raise PermissionDenied("Missing or invalid stats token")
+
 colors = ['black', 'red', 'orange', 'yellow', 'green', 'blue', 'purple', 'brown']
-def handle_reactions(message, is_most_recent):
-    old_color = message['color']
-    new_color = None
-    for reaction in message['reactions']:
-        if 'night' in reaction:
-            new_color = "#000"
-        else:
-            new_color = next((
-                color
-                for color in colors
-                if color in reaction
-            ), None)
-        if new_color == 'brown':
-            # saddle brown
-            new_color = '#8b4513'
-        if new_color:
-            break
-    if old_color != new_color:
-        message["color"] = new_color or '#fff'
+_color_values = {color: color for color in colors} | {'brown': '#8b4513', 'night': '#000'}  # saddle brown
+
+def _name_color(name):
+    """ The original rule, matching whole words: 'night', else the first of `colors` in the name. """
+    words = set(re.split(r'[_-]', name))
+    if 'night' in words:
+        return _color_values['night']
+    return next((_color_values[color] for color in colors if color in words), None)
+
+# color of each standard emoji that has one, built once at startup; every name of an emoji gets
+# the color of whichever of its names has one, so 'heart' is red like 'red_heart'
+reaction_colors = {
+    name: color
+    for names in COLOR_EMOJI_NAMES
+    for color in [next(c for c in map(_name_color, names) if c)]
+    for name in names
+}
+
+def reaction_color(reaction):
+    """ Return the color for a reaction like 'large_blue_circle' or 'heart::skin-tone-2', or None. """
+    name = reaction.split('::')[0]
+    if name in reaction_colors:
+        return reaction_colors[name]
+    # custom emoji
+    return _name_color(name)
+
+def get_reactions(message):
+    """
+        Return message['reactions'] as a dict of {reaction: count}, in the order each reaction
+        was last added, converting messages saved with a plain list of reactions.
+    """
+    if isinstance(message['reactions'], list):
+        # old lists have the most recent reaction first
+        reactions = {}
+        for reaction in reversed(message['reactions']):
+            reactions[reaction] = reactions.pop(reaction, 0) + 1
+        message['reactions'] = reactions
+        message['color_reaction'] = next((r for r in reversed(reactions) if reaction_color(r)), None)
+    return message['reactions']
+
+def add_reaction(message, reaction, is_most_recent):
+    reactions = get_reactions(message)
+    # move the reaction to the end, so that the most recently added colored reaction wins
+    reactions[reaction] = reactions.pop(reaction, 0) + 1
+    if reaction_color(reaction):
+        set_color_reaction(message, reaction, is_most_recent)
+
+def remove_reaction(message, reaction, is_most_recent):
+    reactions = get_reactions(message)
+    count = reactions.get(reaction)
+    if not count:
+        return
+    if count > 1:
+        reactions[reaction] = count - 1
+        return
+    del reactions[reaction]
+    # if the winning reaction is gone, fall back to the most recently added colored reaction
+    if reaction == message.get('color_reaction'):
+        winner = next((r for r in reversed(reactions) if reaction_color(r)), None)
+        set_color_reaction(message, winner, is_most_recent)
+
+def set_color_reaction(message, reaction, is_most_recent):
+    message['color_reaction'] = reaction
+    new_color = (reaction and reaction_color(reaction)) or '#fff'
+    if message['color'] != new_color:
+        message['color'] = new_color
         if is_most_recent:
-            send_state({"color": message["color"]})
+            send_state({"color": new_color})
 
 def extract_emoji_from_message_text(text):
     no_code_blocks = re.sub(r"```.*?```", "", text, flags=re.MULTILINE|re.DOTALL)
@@ -201,32 +267,249 @@ def store_autoplaying_youtube_video(id, youtube_id, start=None, end=None, loop=T
     html = f'<iframe class="youtube" src="https://youtube.com/embed/{youtube_id}?{urlencode(options)}">'
     store_message(id, html, "black")
 
+image_content_types = ('image/jpeg', 'image/gif', 'image/png', 'image/webp')
+
+def fetch_image(url, headers=None, max_bytes=None, timeout=None, session=None, trace=None):
+    """
+        Fetch an image, returning (content_type, content). Raises requests.RequestException or
+        AssertionError if the response isn't a supported image, is larger than max_bytes, or
+        takes longer than timeout overall; timeout also applies to connecting and to each read.
+        The fetch is recorded against trace, or the current thread's trace.
+    """
+    with tracing.span("fetch", trace=trace, url=url), (session or requests).get(url, headers=headers, stream=True, timeout=timeout) as response:
+        assert response.ok, f"{url} returned {response.status_code}"
+        content_type = response.headers.get('Content-Type', '')
+        assert content_type.startswith(image_content_types), f"{url} returned Content-Type {content_type}"
+        chunks = []
+        size = 0
+        started = monotonic()
+        for chunk in response.iter_content(chunk_size=16 * 1024):
+            size += len(chunk)
+            assert max_bytes is None or size <= max_bytes, f"{url} is larger than {max_bytes} bytes"
+            assert timeout is None or monotonic() - started <= timeout, f"{url} took longer than {timeout} seconds"
+            chunks.append(chunk)
+    return content_type, b"".join(chunks)
+
 def fetch_and_store_image_from_url(ts, url, as_curl=False, color=None):
     try:
-        if as_curl:
-            file_response = requests.get(url, headers={'User-Agent': 'curl/7.88.1'})
-        else:
-            file_response = requests.get(url)
-        assert file_response.ok
-        assert any(file_response.headers['Content-Type'].startswith(prefix) for prefix in ('image/jpeg', 'image/gif', 'image/png', 'image/webp'))
+        content_type, content = fetch_image(url, headers={'User-Agent': 'curl/7.88.1'} if as_curl else None)
     except (requests.RequestException, AssertionError) as e:
         logger.error("Failed to fetch URL: %s" % e)
     else:
-        store_image(ts, file_response, color)
+        store_image(ts, content_type, content, color)
+
+image_link_pattern = re.compile(r"<(https?://[^>|\s]+)(?:\|[^>]*)?>")
+image_extensions = ('.jpg', '.jpeg', '.gif', '.png', '.webp')
+_prefetches_in_progress = {}  # url: threading.Event set when the prefetch finishes
+_prefetches_lock = threading.Lock()
+_prefetch_pool = ThreadPoolExecutor(max_workers=settings.PREFETCH_WORKERS, thread_name_prefix="prefetch")
+
+def extract_image_urls_from_message_text(text):
+    """ Return links in Slack message text, e.g. <https://example.com/a.png|label>, that look like images. """
+    urls = [url.replace("&amp;", "&") for url in image_link_pattern.findall(text)]
+    return [url for url in urls if urlparse(url).path.lower().endswith(image_extensions)]
+
+def _prefetch_cache_key(url):
+    return "prefetch:" + hashlib.sha256(url.encode()).hexdigest()
+
+def _check_public_address(conn, sock):
+    address = ipaddress.ip_address(sock.getpeername()[0].split('%')[0])
+    if not address.is_global:
+        sock.close()
+        raise NewConnectionError(conn, f"Refusing to connect to non-public address {address}")
+
+class PublicOnlyHTTPConnection(HTTPConnection):
+    """ Refuses to talk to private, loopback, link-local etc. addresses, checked once connected. """
+    def _new_conn(self):
+        sock = super()._new_conn()
+        _check_public_address(self, sock)
+        return sock
+
+class PublicOnlyHTTPSConnection(HTTPSConnection):
+    """ Refuses to talk to private, loopback, link-local etc. addresses, checked once connected. """
+    def _new_conn(self):
+        sock = super()._new_conn()
+        _check_public_address(self, sock)
+        return sock
+
+class PublicOnlyHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = PublicOnlyHTTPConnection
+
+class PublicOnlyHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = PublicOnlyHTTPSConnection
+
+class PublicOnlyAdapter(requests.adapters.HTTPAdapter):
+    """
+        Transport adapter for fetching links nobody has vetted. The address is checked on the
+        socket actually connected to, after DNS resolution, so a host can't pass a check and then
+        rebind to a private address, and redirects are checked the same way.
+    """
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": PublicOnlyHTTPConnectionPool,
+            "https": PublicOnlyHTTPSConnectionPool,
+        }
+
+def start_prefetch(url):
+    """
+        Queue a speculative fetch of an image URL that Slack is likely to unfurl, unless it's
+        already cached or in progress.
+    """
+    if cache.has_key(_prefetch_cache_key(url)):
+        return
+    with _prefetches_lock:
+        if url in _prefetches_in_progress:
+            return
+        _prefetches_in_progress[url] = threading.Event()
+    _prefetch_pool.submit(prefetch_image, url, tracing.current())
 
-def store_image(id, file_response, color=None):
+def prefetch_image(url, trace=None):
+    """
+        Fetch an image URL queued by start_prefetch(), so that the later message_changed event
+        finds it already in the cache. Unused prefetches simply expire.
+    """
+    metrics.incr("prefetch_started")
+    try:
+        # Slack hasn't vetted the link yet, so refuse private hosts, and ignore proxy settings
+        # that would hide the address actually connected to
+        with requests.Session() as session, tracing.span("prefetch", trace=trace, url=url):
+            session.trust_env = False
+            session.mount("http://", PublicOnlyAdapter())
+            session.mount("https://", PublicOnlyAdapter())
+            image = fetch_image(url, max_bytes=settings.PREFETCH_MAX_BYTES, timeout=settings.PREFETCH_TIMEOUT, session=session)
+    except (requests.RequestException, AssertionError) as e:
+        logger.info("Failed to prefetch URL: %s" % e)
+    else:
+        cache.set(_prefetch_cache_key(url), image, timeout=settings.PREFETCH_TTL)
+    finally:
+        with _prefetches_lock:
+            _prefetches_in_progress.pop(url).set()
+        # the message's handler has usually finished by now, so store the trace again with this span
+        if trace:
+            trace.save()
+
+def get_prefetched_image(url):
+    """ Return (content_type, content) for a prefetched URL, waiting for a prefetch in progress, or None. """
+    in_progress = _prefetches_in_progress.get(url)
+    if in_progress:
+        with tracing.span("prefetch_wait", url=url):
+            in_progress.wait(timeout=settings.PREFETCH_TIMEOUT)
+    image = cache.get(_prefetch_cache_key(url))
+
+    hits = metrics.incr("prefetch_hits", 1 if image else 0)
+    misses = metrics.incr("prefetch_misses", 0 if image else 1)
+    metrics.gauge("prefetch_hit_rate", round(hits / (hits + misses), 3))
+    return image
+
+def encode_image(content_type, content, css_class=None):
+    return "<img%s src='data:%s;base64,%s'>" % (
+        f" class='{css_class}'" if css_class else "",
+        content_type,
+        base64.b64encode(content).decode())
+
+def store_image(id, content_type, content, color=None):
     """ Add requested file to message_history """
-    encoded_image = "<img src='data:%s;base64,%s'>" % (
-        file_response.headers['Content-Type'],
-        base64.b64encode(file_response.content).decode())
-    store_message(id, encoded_image, color)
+    store_message(id, encode_image(content_type, content), color)
+
+def store_gallery(id, images, placeholder=False, replace=False):
+    """
+        Add a list of (content_type, content) images to message_history as a single message,
+        tiled in a grid if there is more than one. If placeholder is True, images are
+        low-resolution thumbnails, to be replaced by a later call with replace=True.
+    """
+    html = "".join(encode_image(*image, "placeholder" if placeholder else None) for image in images)
+    if len(images) > 1:
+        columns = math.ceil(math.sqrt(len(images)))
+        rows = math.ceil(len(images) / columns)
+        html = f"<div class='gallery' style='grid-template-columns: repeat({columns}, 1fr); grid-template-rows: repeat({rows}, 1fr)'>{html}</div>"
+    store_message(id, html, replace=replace)
+
+def fetch_slack_file(session, file_info, thumbnail=False, trace=None):
+    """ Fetch a shared file, or its largest small thumbnail, returning (content_type, content) or None. """
+    if thumbnail:
+        url = next((file_info[k] for k in ('thumb_360', 'thumb_160', 'thumb_80', 'thumb_64') if k in file_info), None)
+        if not url:
+            return None
+    else:
+        url = file_info["url_private"]
+    try:
+        return fetch_image(url, timeout=5 if thumbnail else settings.SHARE_FETCH_TIMEOUT, session=session, trace=trace)
+    except (requests.RequestException, AssertionError) as e:
+        # Slack serves an HTML login page instead of the file if the token is wrong
+        hint = "; check bot_access_token" if "text/html" in str(e) else ""
+        logger.error("Failed to fetch %s%s: %s" % ("thumbnail" if thumbnail else "file", hint, e))
+        return None
 
-def store_message(id, html, color=None):
+def store_shared_files(id, files):
+    """
+        Fetch all the images in a file share concurrently, over one connection pool, and add them
+        to message_history as a single message. If they are large, show Slack's thumbnails while
+        the full files download.
+    """
+    workers = min(len(files), settings.SHARE_FETCH_WORKERS)
+    deadline = monotonic() + settings.SHARE_FETCH_TIMEOUT
+    # neither the pool nor the session is waited on, so a download that misses the deadline can't
+    # hold up the handler; it stops at fetch_image's own deadline
+    session = requests.Session()
+    session.headers["Authorization"] = "Bearer %s" % settings.SLACK["bot_access_token"]
+    session.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=workers))
+    pool = ThreadPoolExecutor(max_workers=workers)
+    try:
+        # start the small thumbnail fetches first, so they aren't queued behind full files;
+        # pool threads don't share this thread's trace, so pass it along for per-file fetch spans
+        trace = tracing.current()
+        thumbnail_futures = []
+        if sum(f.get("size", 0) for f in files) >= settings.PLACEHOLDER_MIN_BYTES:
+            thumbnail_futures = [pool.submit(fetch_slack_file, session, f, thumbnail=True, trace=trace) for f in files]
+        image_futures = [pool.submit(fetch_slack_file, session, f, trace=trace) for f in files]
+
+        # show thumbnails as they arrive, unless the full files beat them
+        placeholder_stored = False
+        try:
+            for future in as_completed(thumbnail_futures, timeout=max(deadline - monotonic(), 0)):
+                if all(f.done() for f in image_futures):
+                    break
+                if future.result():
+                    thumbnails = [f.result() for f in thumbnail_futures if f.done() and f.result()]
+                    store_gallery(id, thumbnails, placeholder=True, replace=placeholder_stored)
+                    placeholder_stored = True
+        except TimeoutError:
+            pass
+        thumbnails = [f.result() if f.done() else None for f in thumbnail_futures]
+
+        done, not_done = wait(image_futures, timeout=max(deadline - monotonic(), 0))
+        if not_done:
+            logger.error("Timed out fetching %s of %s files" % (len(not_done), len(files)))
+
+        # better a sharp thumbnail than a blurry placeholder for any file that failed
+        images = [(f.result() if f in done else None) or (thumbnails[i] if thumbnails else None) for i, f in enumerate(image_futures)]
+        images = [image for image in images if image]
+        if images:
+            store_gallery(id, images, replace=placeholder_stored)
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+def store_message(id, html, color=None, replace=False):
+    """
+        Add a message to message_history. With replace=True, instead update the html of an
+        existing message with the same id, such as a placeholder, keeping its reactions. If that
+        message has since been deleted or dropped from message_history, do nothing.
+    """
     with get_message_history() as message_history:
+        if replace:
+            message, is_most_recent = message_for_ts(message_history, id)
+            if message:
+                message["html"] = html
+                if message.pop("evicted", None):
+                    cache.delete(f"evicted_html:{id}")
+                if is_most_recent:
+                    send_state({"html": html})
+            return
         message_history.append({
             "id": id,
             "html": html,
-            "reactions": [],
+            "reactions": {},
             "color": color or "#fff",
         })
         send_state(message_history[-1])
@@ -236,8 +519,17 @@ def delete_message(id):
         message, is_most_recent = message_for_ts(message_history, id)
         if message:
             message_history.remove(message)
-            if is_most_recent and message_history:
-                send_state(message_history[-1])
+            if message.get('evicted'):
+                cache.delete(f"evicted_html:{id}")
+            if is_most_recent:
+                # show the previous message, skipping any whose evicted html has expired
+                while message_history and not restore_message(message_history[-1]):
+                    message_history.pop()
+                if message_history:
+                    send_state(message_history[-1])
+                else:
+                    # blank the screen, and the cached state sent to displays that connect later
+                    send_state({"html": "", "color": "#fff"})
 
 ### views ###
 
@@ -248,20 +540,46 @@ def slack_event(request):
         verify_slack_request(request)
 
     event = json.loads(request.body.decode("utf-8"))
-    logger.info(event)
 
     # url verification
     if event["type"] == "url_verification":
+        logger.info(event)
         return HttpResponse(event["challenge"], content_type='text/plain')
     else:
+        trace = tracing.Trace(event.get("event", {}).get("type"), event.get("event_time"))
+        logger.info({"trace": trace.id, **event})
+
         # handle event in a background thread so Slack doesn't resend if it takes too long
-        threading.Thread(target=handle_slack_event, args=(event,)).start()
+        threading.Thread(target=handle_slack_event, args=(event, trace)).start()
 
         # 200 to tell Slack not to resend
         return HttpResponse()
 
 
-def handle_slack_event(event):
+def metrics_report(request):
+    """ Report counters and gauges, e.g. per-client lag and dropped frames. """
+    verify_stats_request(request)
+    return JsonResponse(metrics.get_metrics())
+
+
+def slowest_traces_report(request):
+    """ Report the slowest recently traced events, broken down by stage. """
+    verify_stats_request(request)
+    try:
+        count = min(max(int(request.GET.get("count", 20)), 1), 100)
+    except ValueError:
+        count = 20
+    return JsonResponse({"slowest": tracing.slowest_traces(count)})
+
+
+@profiled("handle_slack_event")
+def handle_slack_event(event, trace=None):
+    """ Handle event from Slack, recording the time spent in each stage against trace. """
+    with tracing.activate(trace):
+        _handle_slack_event(event)
+
+
+def _handle_slack_event(event):
 
     event = event["event"]
 
@@ -281,14 +599,10 @@ def handle_slack_event(event):
             #   'ts': '1532713362.000505',
             #   'subtype': 'file_share',
             # }
-            file_info = event["files"][0]
-            if file_info["filetype"] in ("jpg", "gif", "png", "webp"):
-                # if image, fetch file and send to listeners
-                file_response = requests.get(file_info["url_private"], headers={"Authorization": "Bearer %s" % settings.SLACK["bot_access_token"]})
-                if file_response.headers['Content-Type'].startswith('text/html'):
-                    logger.error("Failed to fetch image; check bot_access_token")
-                else:
-                    store_image(event['ts'], file_response)
+            files = [f for f in event["files"] if f.get("filetype") in ("jpg", "gif", "png", "webp")]
+            if files:
+                # if images, fetch files and send to listeners
+                store_shared_files(event['ts'], files)
 
         # handle pasted URL
         elif message_type == "message_changed":
@@ -326,7 +640,11 @@ def handle_slack_event(event):
                     #      'ts': '1532713362.000505',
                     #   },
                     # }
-                    fetch_and_store_image_from_url(message['ts'], attachment['image_url'])
+                    prefetched = get_prefetched_image(attachment['image_url'])
+                    if prefetched:
+                        store_image(message['ts'], *prefetched)
+                    else:
+                        fetch_and_store_image_from_url(message['ts'], attachment['image_url'])
 
             elif event['previous_message'].get('attachments'):
                 # if edited message doesn't have attachment but previous_message did, attachment was hidden -- delete
@@ -343,6 +661,11 @@ def handle_slack_event(event):
             #     "text": "Hello world",
             #     "ts": "1355517523.000005"
             # }
+
+            # start fetching linked images now, rather than waiting for Slack to unfurl them
+            for url in extract_image_urls_from_message_text(event.get("text", ""))[:settings.PREFETCH_MAX_URLS]:
+                start_prefetch(url)
+
             emoji_list = extract_emoji_from_message_text(event.get("text", ""))
             if emoji_list:
                 if "hotfire" in emoji_list and settings.ASCII_FIRE_URL:
@@ -377,17 +700,11 @@ def handle_slack_event(event):
         with get_message_history() as message_history:
             message, is_most_recent = message_for_ts(message_history, event['item']['ts'])
             if message:
-                message['reactions'].insert(0, event["reaction"])
-                handle_reactions(message, is_most_recent)
+                add_reaction(message, event["reaction"], is_most_recent)
 
     elif event["type"] == "reaction_removed":
         with get_message_history() as message_history:
             message, is_most_recent = message_for_ts(message_history, event['item']['ts'])
             if message:
-                try:
-                    message['reactions'].remove(event["reaction"])
-                except ValueError:
-                    pass
-                else:
-                    handle_reactions(message, is_most_recent)
+                remove_reaction(message, event["reaction"], is_most_recent)
 